@@ -25,6 +25,9 @@ class BasicController(LeafSystem):
         self.plant = plant
         self.context = self.plant.CreateDefaultContext()  # stores q,qd
 
+        # The actuation matrix is constant, so we only need to compute it once
+        self.S = self.plant.MakeActuationMatrix().T
+
         # AutoDiff plant and context for values that require automatic differentiation
         self.plant_autodiff = plant.ToAutoDiffXd()
         self.context_autodiff = self.plant_autodiff.CreateDefaultContext()
@@ -110,7 +113,7 @@ class BasicController(LeafSystem):
         M = self.plant.CalcMassMatrixViaInverseDynamics(self.context)
         Cv = self.plant.CalcBiasTerm(self.context)
         tau_g = -self.plant.CalcGravityGeneralizedForces(self.context)
-        S = self.plant.MakeActuationMatrix().T
+        S = self.S
 
         return M, Cv, tau_g, S
 
@@ -307,7 +310,7 @@ class BasicController(LeafSystem):
         if self.use_lcm:
             # Send control outputs over LCM
             msg = robot_state_control_lcmt()
-            S = self.plant.MakeActuationMatrix().T
+            S = self.S
             msg.tau = (S.T@u)[-self.plant.num_actuators():]   # The mini cheetah controller assumes
                                                               # control torques are in the same order as 
                                                               # v, but drake uses a different (custom) mapping. 
@@ -1,4 +1,127 @@
 from controllers.inverse_dynamics_controller import *
+from helpers import rpyd_to_angular_velocity_matrix
+from numba import njit
+from functools import lru_cache
+from scipy.linalg import solve_continuous_are
+
+def _task_space_dynamics(m):
+    """
+    Construct the matrices F, G defining the task-space dynamics 
+
+        eta_dot = F*eta + G*nu,
+
+    where eta = [x_tilde, xd_tilde], nu = xdd_tilde, and m is the 
+    dimension of x_tilde. The returned arrays are read-only. 
+    """
+    F = np.zeros((2*m,2*m))
+    F[:m,m:] = np.eye(m)
+    G = np.zeros((2*m,m))
+    G[m:,:] = np.eye(m)
+
+    F.setflags(write=False)
+    G.setflags(write=False)
+
+    return F, G
+
+# Task-space dynamics for each possible number of swing feet 
+_F, _G = zip(*[_task_space_dynamics(6 + 3*num_swing) for num_swing in range(5)])
+
+@lru_cache(maxsize=None)
+def _clf_terms(num_swing, Q_body_rpy, Q_body_p, Q_body_rpyd, Q_body_pd, Q_foot_p, Q_foot_pd, r):
+    """
+    Compute the Cholesky factor L of the solution P of the CARE associated with
+    the task-space dynamics 
+
+        eta_dot = F*eta + G*nu,
+
+    and the convergence rate gamma for the candidate CLF V = eta'*P*eta, with 
+    the given number of swing feet and LQR cost weights. 
+
+    These only depend on constant parameters, so they are computed once and
+    shared between all CLFController instances. The returned factor L is read-only.
+    """
+    # Cost matrices associated w/ infinite horizon cost sum_t eta'*Q*eta + nu'*R*nu
+    # where eta = [x_tilde, xd_tilde] and nu = xdd_tilde
+    nf = 3*num_swing   # there are 3 foot-related variables (x,y,z positions) for each swing foot
+    m = 6 + nf
+   
+    Qp = np.block([[ np.kron(np.diag([Q_body_rpy, Q_body_p]),np.eye(3)), np.zeros((6,nf))   ],
+                   [ np.zeros((nf,6)),                                     Q_foot_p*np.eye(nf) ]])
+    
+    Qd = np.block([[ np.kron(np.diag([Q_body_rpyd, Q_body_pd]),np.eye(3)), np.zeros((6,nf))   ],
+                   [ np.zeros((nf,6)),                                     Q_foot_pd*np.eye(nf) ]])
+
+    Q = np.block([[ Qp,              np.zeros((m,m))],
+                  [ np.zeros((m,m)), Qd             ]])
+   
+    R = r*np.eye(m)
+    
+    # Solve CARE to determine candidate CLF eta'*P*eta
+    F = _F[num_swing]
+    G = _G[num_swing]
+
+    P = solve_continuous_are(F,G,Q,R)
+    L = np.linalg.cholesky(P)
+
+    # Q is diagonal and P is symmetric, so we can avoid general 
+    # (complex) eigenvalue computations here
+    gamma = np.min(np.diag(Q)) / np.linalg.eigvalsh(P)[-1]
+
+    L.setflags(write=False)
+
+    return L, gamma
+
+@njit(cache=True, fastmath=True)
+def _vdot_terms(L, gamma, eta, J, Jdv, xdd_nom):
+    """
+    Compute the terms needed to write 
+
+        Vdot = 2*eta'*P*F*eta + 2*eta'*P*G*(J*vd + Jdv - xdd_nom)
+
+    as a linear function of vd, where V = eta'*P*eta, P = L*L' is the Cholesky
+    factorization of P, and F = [0 I; 0 0], G = [0; I].
+
+    Returns PG_eta = 2*eta'*P*G, a = PG_eta*J, ub = -gamma*V - 2*eta'*P*F*eta 
+    - PG_eta*(Jdv - xdd_nom), and V, so that Vdot <= -gamma*V + delta is 
+    equivalent to a*vd - delta <= ub.
+    """
+    n = eta.shape[0]
+    m = n // 2
+    nv = J.shape[1]
+
+    # u = L'*eta and w = L'*F*eta, where F*eta = [xd_tilde; 0]
+    u = np.zeros(n)
+    w = np.zeros(n)
+    for i in range(n):
+        for j in range(i, n):
+            u[i] += L[j,i]*eta[j]
+        for j in range(i, m):
+            w[i] += L[j,i]*eta[m+j]
+
+    # V = eta'*P*eta = u'*u and 2*eta'*P*F*eta = 2*u'*w
+    V = 0.0
+    eta_PF_eta = 0.0
+    for i in range(n):
+        V += u[i]*u[i]
+        eta_PF_eta += 2*u[i]*w[i]
+
+    # 2*eta'*P*G = 2*u'*L'*G, where L'*G is the last m columns of L'
+    PG_eta = np.zeros(m)
+    for j in range(m):
+        for i in range(m+j+1):
+            PG_eta[j] += 2*u[i]*L[m+j,i]
+
+    # PG_eta*J and PG_eta*(Jdv - xdd_nom)
+    a = np.zeros(nv)
+    b = 0.0
+    for j in range(m):
+        b += PG_eta[j]*(Jdv[j] - xdd_nom[j])
+        for k in range(nv):
+            a[k] += PG_eta[j]*J[j,k]
+
+    ub = -gamma*V - eta_PF_eta - b
+
+    return PG_eta, a, ub, V
 
 class CLFController(IDController):
     """
@@ -11,38 +134,236 @@ class CLFController(IDController):
     def __init__(self, plant, dt, use_lcm=False):
         IDController.__init__(self, plant, dt, use_lcm=use_lcm)
 
+        ######### Tuning Parameters #########
+        Q_body_p = 5000.0             # Lyapunov function is based on CARE solution
+        Q_body_pd = 200.0            # corresponding to LQR with running cost 
+                                      # eta'*Q*eta + nu'*R*nu
+        Q_body_rpy = Q_body_p
+        Q_body_rpyd = Q_body_pd
+
+        Q_foot_p = 200.0
+        Q_foot_pd = 20.0
+
+        self.r = 1.0
+
+        self.w_delta = 1000
+        #####################################
+
+        # The candidate CLF eta'*P*eta only depends on the number of swing feet,
+        # so we look up the CARE solution for each possible number of swing feet 
+        # up front. These lists are indexed by the number of swing feet. 
+        self.L = []      # P = L*L'
+        self.gamma = []
+
+        for num_swing in range(5):
+            L, gamma = _clf_terms(num_swing, Q_body_rpy, Q_body_p, Q_body_rpyd,
+                                  Q_body_pd, Q_foot_p, Q_foot_pd, self.r)
+            self.L.append(L)
+            self.gamma.append(gamma)
+
+        # The structure of the whole-body QP is the same at every timestep, so
+        # we set it up once here and only update the coefficients in ControlLaw.
+        # Contact forces are allocated for all four feet: forces at the swing
+        # feet are simply constrained to zero.
+        nv = self.plant.num_velocities()
+        nu = self.plant.num_actuators()
+
+        self.mp = MathematicalProgram()
+
+        self.vd = self.mp.NewContinuousVariables(nv, 1, 'vd')
+        self.tau = self.mp.NewContinuousVariables(nu, 1, 'tau')
+        self.f_c = [self.mp.NewContinuousVariables(3,1,'f_%s'%j) for j in range(4)]
+        self.delta = self.mp.NewContinuousVariables(1,'delta')
+        f = np.vstack(self.f_c)
+
+        # min || J*vd + Jd*v - xdd_des ||^2
+        self.task_cost = self.mp.AddQuadraticCost(np.eye(nv), np.zeros(nv), self.vd, is_convex=True)
+
+        # min Vdot
+        self.vdot_cost = self.mp.AddLinearCost(np.zeros(nv), b=0.0, vars=self.vd)
+
+        # min w_delta* delta^2
+        self.mp.AddCost(self.w_delta*self.delta.T@self.delta)
+
+        # s.t. Vdot <= -gamma*V + delta
+        self.vdot_constraint = self.mp.AddLinearConstraint(A=np.zeros((1,nv+1)),
+                                                           lb=-np.inf*np.ones(1),
+                                                           ub=np.zeros(1),
+                                                           vars=np.vstack([self.vd,self.delta]))
+
+        # s.t. delta <= 0
+        #self.mp.AddLinearConstraint( self.delta[0] <= 0 )
+
+        # s.t.  M*vd + Cv + tau_g = S'*tau + sum(J_c[j]'*f_c[j])
+        self.dynamics_constraint = self.mp.AddLinearEqualityConstraint(np.zeros((nv,nv+nu+12)),
+                                                                       np.zeros(nv),
+                                                                       np.vstack([self.vd,self.tau,f]))
+
+        # s.t. f_c[j] in friction cones
+        self.AddFrictionPyramidConstraint(self.f_c)
+
+        # s.t. J_cj*vd + Jd_cj*v == 0 (+ some damping) for feet in contact
+        self.contact_constraint = self.mp.AddLinearConstraint(A=np.zeros((12,nv)),
+                                                              lb=np.zeros(12),
+                                                              ub=np.zeros(12),
+                                                              vars=self.vd)
+
+        # s.t. f_s[j] == 0 for feet in swing
+        self.swing_force_constraint = self.mp.AddBoundingBoxConstraint(np.zeros(12), np.zeros(12), f)
+
+        # Storage for task-space quantities, sized for the maximum number of 
+        # swing feet: x = [rpy_body, p_body, p_s] has at most 6 + 3*4 entries
+        self._x = np.empty(18)
+        self._xd = np.empty(18)
+        self._x_nom = np.empty(18)
+        self._xd_nom = np.empty(18)
+        self._xdd_nom = np.empty(18)
+        self._eta = np.empty(36)     # eta = [x_tilde, xd_tilde]
+        self._J_buf = np.empty((18,nv))
+        self._Jdv_buf = np.empty(18)
+
+        # Compile the Vdot kernel now rather than during the first control step.
+        # Arguments match the dtypes, layouts and read-only flags used in ControlLaw.
+        _vdot_terms(self.L[0], self.gamma[0], np.zeros(12), np.zeros((6,nv)), np.zeros(6), np.zeros(6))
+
+        # Storage for constraint data, which is updated in place. The dynamics
+        # constraint matrix is [M, -S', -J_lf', -J_rf', -J_lh', -J_rh'], where
+        # the -S' block never changes. 
+        self._A_dyn = np.zeros((nv,nv+nu+12))
+        self._A_dyn[:,nv:nv+nu] = -self.S.T
+        self._contact_lb = np.zeros(12)
+        self._contact_ub = np.zeros(12)
+
+        # Indices of feet in contact and in swing, along with storage for the
+        # swing foot quantities. These only change when the contact states do.
+        self._last_contact_tuple = None
+        self.UpdateContactIndices([True, True, True, True])
+
+        # OSQP settings: since consecutive QPs are very similar, we warm-start
+        # each solve with the solution from the previous timestep.
+        self.solver_options = SolverOptions()
+        self.solver_options.SetOption(OsqpSolver.id(), "eps_abs", 1e-3)
+        self.solver_options.SetOption(OsqpSolver.id(), "eps_rel", 1e-3)
+        self.solver_options.SetOption(OsqpSolver.id(), "warm_start", 1)
+        self.initial_guess = None
+
+        # Torques from the last successful solve, which we fall back on
+        # if the QP solver fails, and whether the last solve failed
+        self._prev_tau = np.zeros((nu,1))
+        self._solve_failed = False
+
+    def UpdateContactIndices(self, contact_feet):
+        """
+        Update the integer indices of feet in contact (self._contact_idx) and
+        feet in swing (self._swing_idx), storage for quantities associated 
+        with the swing feet, and the parts of the QP that only depend on 
+        which feet are in contact. 
+        
+        Does nothing unless the contact states have changed since the last call.
+        """
+        ct = tuple(contact_feet)
+        if ct == self._last_contact_tuple:
+            return
+        self._last_contact_tuple = ct
+
+        self._contact_idx = np.flatnonzero(ct)
+        self._swing_idx = np.flatnonzero(np.logical_not(ct))
+
+        num_swing = len(self._swing_idx)
+        self._p_s_nom_buf = np.empty((num_swing,3))
+        self._pd_s_nom_buf = np.empty((num_swing,3))
+        self._pdd_s_nom_buf = np.empty((num_swing,3))
+        self._p_s_buf = np.empty((num_swing,3))
+        self._pd_s_buf = np.empty((num_swing,3))
+
+        # Rows of the stacked contact constraint that correspond to feet in contact.
+        # Rows for feet in swing are left unconstrained.
+        self._contact_rows = (3*self._contact_idx[:,np.newaxis] + np.arange(3)).ravel()
+        self._contact_lb[:] = -np.inf
+        self._contact_ub[:] = np.inf
+
+        # Contact forces are free for feet in contact (up to the friction 
+        # cone constraints) and zero for feet in swing
+        f_lb = np.zeros(12)
+        f_ub = np.zeros(12)
+        f_lb[self._contact_rows] = -np.inf
+        f_ub[self._contact_rows] = np.inf
+        self.swing_force_constraint.evaluator().set_bounds(f_lb, f_ub)
+
+    def UpdateJacobianTypeCost(self, J, Jd_qd, xdd_des, weight=1.0):
+        """
+        Update the quadratic cost
+            weight*| J*vd + Jd_qd - xdd_des |^2
+        in the whole-body controller QP.
+        """
+        # Put in the form 1/2*vd'*Q*vd + c'*vd
+        Q, c = self.CalcJacobianTypeCostCoefficients(J, Jd_qd, xdd_des, weight=weight)
+
+        # J'*J is rank-deficient in general, so we tell Drake the cost is convex
+        # rather than have it check positive semidefiniteness numerically
+        self.task_cost.evaluator().UpdateCoefficients(Q, c, 0.0, is_convex=True)
 
-    def AddVdotCost(self, x_tilde, xd_tilde, P, G, J, vd, weight=1):
+    def UpdateVdotCost(self, a, weight=1):
         """
-        Add a cost penalizing the time derivative of the Lyapunov function
+        Update the cost penalizing the time derivative of the Lyapunov function
 
-            V = eta'*P*eta
+            V = eta'*P*eta,
 
-        where eta = [x_tilde;xd_tilde]
+        where eta = [x_tilde;xd_tilde]. Up to terms that do not depend on vd, 
+        Vdot = a*vd with a = 2*eta'*P*G*J (see _vdot_terms).
         """
-        eta = np.hstack([x_tilde,xd_tilde])
-        a = weight*2*eta.T @ P @ G @ J
-        return self.mp.AddLinearCost(a,b=0.0,vars=vd)
+        self.vdot_cost.evaluator().UpdateCoefficients(weight*a, 0.0)
 
-    def AddVdotConstraint(self, x_tilde, xd_tilde, P, G, J, gamma, F, vd, Jdv, xdd_nom, delta):
+    def UpdateVdotConstraint(self, a, ub):
         """
-        Add a constraint Vdot <= -gamma*V + delta to the whole-body QP, where
+        Update the constraint Vdot <= -gamma*V + delta in the whole-body QP, where
             
             V = eta'*P*eta
 
-        and eta = [x_tilde;xd_tilde]
+        and eta = [x_tilde;xd_tilde]. This is equivalent to a*vd - delta <= ub, 
+        with a and ub given by _vdot_terms.
         """
-        eta = np.hstack([x_tilde, xd_tilde])
-        V = eta.T@P@eta
-
-        # We'll write as lb <= A*x <= ub
+        # We'll write as lb <= A*[vd;delta] <= ub
         lb = np.asarray(-np.inf).reshape(1,)
-        A = np.hstack([2*eta.T@P@G@J, -1])[np.newaxis]
-        x = np.vstack([vd,delta])
-        ub = -gamma*V - 2*eta.T@P@F@eta -2*eta.T@P@G@(Jdv - xdd_nom)
+        A = np.hstack([a, -1])[np.newaxis]
         ub = np.asarray(ub).reshape(1,)
 
-        return self.mp.AddLinearConstraint(A=A,lb=lb,ub=ub,vars=x)
+        self.vdot_constraint.evaluator().UpdateCoefficients(A, lb, ub)
+
+    def UpdateDynamicsConstraint(self, M, Cv, tau_g, J_feet):
+        """
+        Update the dynamics constraint
+            M*vd + Cv + tau_g == S'*tau + sum(J_feet[j]'*f_c[j])
+        in the whole-body controller QP. 
+        """
+        nv = M.shape[0]
+
+        A_eq = self._A_dyn
+        A_eq[:,:nv] = M
+        A_eq[:,-12:] = -J_feet.reshape(12,nv).T
+        b_eq = -Cv-tau_g
+
+        self.dynamics_constraint.evaluator().UpdateCoefficients(A_eq, b_eq)
+
+    def UpdateContactConstraint(self, J_feet, Jdv_feet, v):
+        """
+        Update the contact constraints with velocity damping
+
+            J_c[j]*vd + Jdv_c[j] == -Kd*J_c[j]*v
+
+        for feet in contact. Rows for feet in swing are left unconstrained
+        (see UpdateContactIndices).
+        """
+        Kd = 100
+
+        A = J_feet.reshape(12,-1)
+        b = -Kd*A@v - Jdv_feet.ravel()
+
+        rows = self._contact_rows
+        self._contact_lb[rows] = b[rows]
+        self._contact_ub[rows] = b[rows]
+
+        self.contact_constraint.evaluator().UpdateCoefficients(A, self._contact_lb, self._contact_ub)
 
 
     def ControlLaw(self, context, q, v):
@@ -62,31 +383,17 @@ class CLFController(IDController):
             V = [x_tilde ]^T * P * [x_tilde ]
                 [xd_tilde]         [xd_tilde]
         """
-        ######### Tuning Parameters #########
-        Q_body_p = 5000.0             # Lyapunov function is based on CARE solution
-        Q_body_pd = 200.0            # corresponding to LQR with running cost 
-                                      # eta'*Q*eta + nu'*R*nu
-        Q_body_rpy = Q_body_p
-        Q_body_rpyd = Q_body_pd
-
-        Q_foot_p = 200.0
-        Q_foot_pd = 20.0
-
-        r = 1.0
-
-        w_delta = 1000
-        #####################################
-        
         # Compute Dynamics Quantities
-        M, Cv, tau_g, S = self.CalcDynamics()
+        M, Cv, tau_g, _ = self.CalcDynamics()   # S is fixed in the QP
 
         # Get setpoint data from the trunk model
         trunk_data = self.EvalAbstractInput(context,1).get_value()
         
         contact_feet = trunk_data["contact_states"]       # Note: it may be better to determine
-        swing_feet = [not foot for foot in contact_feet]  # contact states from the actual robot rather than
-        num_contact = sum(contact_feet)                   # the planned trunk trajectory.
-        num_swing = sum(swing_feet)
+        self.UpdateContactIndices(contact_feet)           # contact states from the actual robot rather than
+        swing_idx = self._swing_idx                       # the planned trunk trajectory.
+        num_contact = len(self._contact_idx)
+        num_swing = len(swing_idx)
 
         p_body_nom = trunk_data["p_body"]
         pd_body_nom = trunk_data["pd_body"]
@@ -100,9 +407,11 @@ class CLFController(IDController):
         pd_feet_nom = np.array([trunk_data["pd_lf"],trunk_data["pd_rf"],trunk_data["pd_lh"],trunk_data["pd_rh"]])
         pdd_feet_nom = np.array([trunk_data["pdd_lf"],trunk_data["pdd_rf"],trunk_data["pdd_lh"],trunk_data["pdd_rh"]])
 
-        p_s_nom = p_feet_nom[swing_feet]
-        pd_s_nom = pd_feet_nom[swing_feet]
-        pdd_s_nom = pdd_feet_nom[swing_feet]
+        # The swing indices are always in range, so mode='clip' lets np.take write
+        # directly into the preallocated output rather than an intermediate buffer
+        p_s_nom = np.take(p_feet_nom, swing_idx, axis=0, out=self._p_s_nom_buf, mode='clip')
+        pd_s_nom = np.take(pd_feet_nom, swing_idx, axis=0, out=self._pd_s_nom_buf, mode='clip')
+        pdd_s_nom = np.take(pdd_feet_nom, swing_idx, axis=0, out=self._pdd_s_nom_buf, mode='clip')
 
         # Get robot's actual task-space (body pose + foot positions) data
         X_body, J_body, Jdv_body = self.CalcFramePoseQuantities(self.body_frame)
@@ -110,125 +419,101 @@ class CLFController(IDController):
         p_body = X_body.translation()
         pd_body = (J_body@v)[3:]
 
-        RPY_body = RollPitchYaw(X_body.rotation())  # RPY object helps convert between angular velocity and rpyd
-        rpy_body = RPY_body.vector()
+        rpy_body = RollPitchYaw(X_body.rotation()).vector()
         omega_body = (J_body@v)[:3]   # angular velocity of the body
-        rpyd_body = RPY_body.CalcRpyDtFromAngularVelocityInParent(omega_body)
-
-        p_lf, J_lf, Jdv_lf = self.CalcFramePositionQuantities(self.lf_foot_frame)
-        p_rf, J_rf, Jdv_rf = self.CalcFramePositionQuantities(self.rf_foot_frame)
-        p_lh, J_lh, Jdv_lh = self.CalcFramePositionQuantities(self.lh_foot_frame)
-        p_rh, J_rh, Jdv_rh = self.CalcFramePositionQuantities(self.rh_foot_frame)
-       
-        p_feet = np.array([p_lf, p_rf, p_lh, p_rh]).reshape(4,3)
-        J_feet = np.array([J_lf, J_rf, J_lh, J_rh])
-        Jdv_feet = np.array([Jdv_lf, Jdv_rf, Jdv_lh, Jdv_rh])
-        pd_feet = J_feet@v
-
-        p_s = p_feet[swing_feet]
-        pd_s = pd_feet[swing_feet]
+        E = rpyd_to_angular_velocity_matrix(rpy_body)   # omega = E*rpyd
 
-        J_c = J_feet[contact_feet]
-        Jdv_c = Jdv_feet[contact_feet]
-        
-        J_s = J_feet[swing_feet]
-        Jdv_s = Jdv_feet[swing_feet]
+        p_feet, J_feet, Jdv_feet = self.CalcAllFootJacobians()
+        pd_feet = J_feet@v
 
-        # Additional task-space dynamics terms
-        if any(swing_feet):
-            J = np.vstack([J_body, np.vstack(J_s)])
-            Jdv = np.hstack([Jdv_body, np.vstack(Jdv_s).flatten()])
-        else:
-            J = J_body
-            Jdv = Jdv_body
+        p_s = np.take(p_feet, swing_idx, axis=0, out=self._p_s_buf, mode='clip')
+        pd_s = np.take(pd_feet, swing_idx, axis=0, out=self._pd_s_buf, mode='clip')
 
-        # Task-space states and errors
-        x = np.hstack([rpy_body, p_body, p_s.flatten()])
-        xd = np.hstack([RPY_body.CalcAngularVelocityInParentFromRpyDt(rpyd_body),
-                        pd_body,
-                        pd_s.flatten()])
-
-        x_nom = np.hstack([rpy_body_nom, p_body_nom, p_s_nom.flatten()])
-        xd_nom = np.hstack([RPY_body.CalcAngularVelocityInParentFromRpyDt(rpyd_body_nom),
-                            pd_body_nom,
-                            pd_s_nom.flatten()])
-        xdd_nom = np.hstack([RPY_body.CalcAngularVelocityInParentFromRpyDt(rpydd_body_nom),
-                             pdd_body_nom, 
-                             pdd_s_nom.flatten()])
-
-        x_tilde = x - x_nom
-        xd_tilde = xd - xd_nom
-        
-        eta = np.hstack([x_tilde,xd_tilde])
-
-        # Cost matrices associated w/ infinite horizon cost sum_t eta'*Q*eta + nu'*R*nu
-        # where eta = [x_tilde, xd_tilde] and nu = xdd_tilde
-        m = len(x_tilde)
-        
-        nf = 3*sum(swing_feet)   # there are 3 foot-related variables (x,y,z positions) for each swing foot
-       
-        Qp = np.block([[ np.kron(np.diag([Q_body_rpy, Q_body_p]),np.eye(3)), np.zeros((6,nf))   ],
-                       [ np.zeros((nf,6)),                                     Q_foot_p*np.eye(nf) ]])
-        
-        Qd = np.block([[ np.kron(np.diag([Q_body_rpyd, Q_body_pd]),np.eye(3)), np.zeros((6,nf))   ],
-                       [ np.zeros((nf,6)),                                     Q_foot_pd*np.eye(nf) ]])
+        # Additional task-space dynamics terms: J = [J_body; J_s], Jdv = [Jdv_body; Jdv_s]
+        m = 6 + 3*num_swing
 
-        Q = np.block([[ Qp,              np.zeros((m,m))],
-                      [ np.zeros((m,m)), Qd             ]])
-       
-        R = r*np.eye(m)
-        
-        # Solve CARE to determine candidate CLF eta'*P*eta
-        F = np.block([[np.zeros((m,m)), np.eye(m)      ],    # task-space dynamics
-                      [np.zeros((m,m)), np.zeros((m,m))]])   # eta_dot = F*eta + G*nu
-        G = np.block([[np.zeros((m,m))],                     # eta = [x_tilde, xd_tilde]
-                      [np.eye(m)]])                          # nu = xdd_tilde
-        
-        P = ContinuousAlgebraicRiccatiEquation(F,G,Q,R)
-        gamma = np.min(np.linalg.eigvals(Q)) / np.max(np.linalg.eigvals(P))
+        J = self._J_buf[:m]
+        J[:6] = J_body
+        np.take(J_feet, swing_idx, axis=0, out=J[6:].reshape((num_swing,)+J_feet.shape[1:]), mode='clip')
 
-        # Set up and solve the QP
-        self.mp = MathematicalProgram()
-        
-        vd = self.mp.NewContinuousVariables(self.plant.num_velocities(), 1, 'vd')
-        tau = self.mp.NewContinuousVariables(self.plant.num_actuators(), 1, 'tau')
-        f_c = [self.mp.NewContinuousVariables(3,1,'f_%s'%j) for j in range(num_contact)]
-        delta = self.mp.NewContinuousVariables(1,'delta')
+        Jdv = self._Jdv_buf[:m]
+        Jdv[:6] = Jdv_body
+        np.take(Jdv_feet, swing_idx, axis=0, out=Jdv[6:].reshape(num_swing,3), mode='clip')
 
+        # Task-space states and errors
+        x = self._x[:m]
+        x[0:3] = rpy_body
+        x[3:6] = p_body
+        x[6:] = p_s.ravel()
+
+        xd = self._xd[:m]
+        xd[0:3] = omega_body
+        xd[3:6] = pd_body
+        xd[6:] = pd_s.ravel()
+
+        x_nom = self._x_nom[:m]
+        x_nom[0:3] = rpy_body_nom
+        x_nom[3:6] = p_body_nom
+        x_nom[6:] = p_s_nom.ravel()
+
+        xd_nom = self._xd_nom[:m]
+        xd_nom[0:3] = E@rpyd_body_nom
+        xd_nom[3:6] = pd_body_nom
+        xd_nom[6:] = pd_s_nom.ravel()
+
+        xdd_nom = self._xdd_nom[:m]
+        xdd_nom[0:3] = E@rpydd_body_nom
+        xdd_nom[3:6] = pdd_body_nom
+        xdd_nom[6:] = pdd_s_nom.ravel()
+
+        eta = self._eta[:2*m]
+        x_tilde = np.subtract(x, x_nom, out=eta[:m])
+        xd_tilde = np.subtract(xd, xd_nom, out=eta[m:])
+
+        # Candidate CLF V = eta'*P*eta, where P = L*L'
+        L = self.L[num_swing]
+        gamma = self.gamma[num_swing]
+
+        PG_eta, a, ub, V = _vdot_terms(L, gamma, eta, J, Jdv, xdd_nom)
+
+        # Update and solve the QP
         # min || J*vd + Jd*v - xdd_des ||^2
-        xdd_des = xdd_nom - np.linalg.inv(R)@G.T@P@eta    # use optimal LQR feedback gains here
-        self.AddJacobianTypeCost(J, vd, Jdv, xdd_des, weight=1.0)
+        xdd_des = xdd_nom - 0.5/self.r*PG_eta    # use optimal LQR feedback gains here
+        self.UpdateJacobianTypeCost(J, Jdv, xdd_des, weight=1.0)
 
         # min Vdot
-        self.AddVdotCost(x_tilde, xd_tilde, P, G, J, vd, weight=1)
-
-        # min w_delta* delta^2
-        self.mp.AddCost(w_delta*delta.T@delta)
+        self.UpdateVdotCost(a, weight=1)
 
         # s.t. Vdot <= -gamma*V + delta
-        self.AddVdotConstraint(x_tilde, xd_tilde, P, G, J, gamma, F, vd, Jdv, xdd_nom, delta)
-
-        # s.t. delta <= 0
-        #self.mp.AddLinearConstraint( delta[0] <= 0 )
+        self.UpdateVdotConstraint(a, ub)
 
         # s.t.  M*vd + Cv + tau_g = S'*tau + sum(J_c[j]'*f_c[j])
-        self.AddDynamicsConstraint(M, vd, Cv, tau_g, S, tau, J_c, f_c)
+        self.UpdateDynamicsConstraint(M, Cv, tau_g, J_feet)
 
-        if any(contact_feet):
-            # s.t. f_c[j] in friction cones
-            self.AddFrictionPyramidConstraint(f_c)
-
-            # s.t. J_cj*vd + Jd_cj*v == 0 (+ some daming)
-            self.AddContactConstraint(J_c, vd, Jdv_c, v)
+        # s.t. J_cj*vd + Jd_cj*v == 0 (+ some daming)
+        self.UpdateContactConstraint(J_feet, Jdv_feet, v)
     
-        result = self.solver.Solve(self.mp)
-        assert result.is_success()
-        tau = result.GetSolution(tau)
-        vd = result.GetSolution(vd)
+        result = self.solver.Solve(self.mp, self.initial_guess, self.solver_options)
 
         # Logging
-        self.V = eta.T@P@eta
+        self.V = V
         self.err = x_tilde.T@x_tilde
-        self.Vdot = 2*eta.T@P@F@eta + 2*eta.T@P@G@(J@vd + Jdv - xdd_nom)
+
+        if not result.is_success():
+            # Only warn at the start of a streak of failed solves
+            if not self._solve_failed:
+                print("Warning: CLF-QP solve failed at t=%s, reusing previous torques" % context.get_time())
+            self._solve_failed = True
+            self.Vdot = np.nan
+
+            return self._prev_tau
+        self._solve_failed = False
+        self.initial_guess = result.get_x_val()
+
+        tau = result.GetSolution(self.tau)
+        vd = result.GetSolution(self.vd)
+        self._prev_tau = tau
+
+        self.Vdot = a@vd.ravel() - ub - gamma*V
 
         return tau
@@ -18,10 +18,48 @@ class IDController(BasicController):
         # Set the friction coefficient
         self.mu = 0.7
 
+        # Foot frames, in the same order as the contact states sent from the 
+        # trunk model, and storage for the corresponding jacobians
+        self.foot_frames = [self.lf_foot_frame, self.rf_foot_frame, 
+                            self.lh_foot_frame, self.rh_foot_frame]
+        self._p_feet = np.empty((4,3))
+        self._J_feet = np.empty((4,3,self.plant.num_velocities()))
+        self._Jdv_feet = np.empty((4,3))
+
         # Choose a solver
         #self.solver = GurobiSolver()
         self.solver = OsqpSolver()
     
+    def CalcAllFootJacobians(self):
+        """
+        Compute the positions (p_feet), jacobians (J_feet) and 
+        jacobian-time-derivative-times-v (Jdv_feet) for all four feet,
+        in the order [lf, rf, lh, rh].
+
+        Results are written to preallocated storage, which is overwritten 
+        by the next call. 
+        
+        Assumes that self.context has been set properly. 
+        """
+        for i, frame in enumerate(self.foot_frames):
+            p, J, Jdv = self.CalcFramePositionQuantities(frame)
+            self._p_feet[i] = p[:,0]
+            self._J_feet[i] = J
+            self._Jdv_feet[i] = Jdv[:,0]
+
+        return self._p_feet, self._J_feet, self._Jdv_feet
+
+    def CalcJacobianTypeCostCoefficients(self, J, Jd_qd, xdd_des, weight=1.0):
+        """
+        Compute Q, c such that the quadratic cost
+            weight*| J*qdd + Jd_qd - xdd_des |^2
+        is written (up to a constant) as 1/2*qdd'*Q*qdd + c'*qdd.
+        """
+        Q = weight*np.dot(J.T,J)
+        c = weight*(np.dot(Jd_qd.T,J) - np.dot(xdd_des.T,J)).T
+
+        return Q, c
+
     def AddJacobianTypeCost(self, J, qdd, Jd_qd, xdd_des, weight=1.0):
         """
         Add a quadratic cost of the form
@@ -29,8 +67,7 @@ class IDController(BasicController):
         to the whole-body controller QP.
         """
         # Put in the form 1/2*qdd'*Q*qdd + c'*qdd for fast formulation
-        Q = weight*np.dot(J.T,J)
-        c = weight*(np.dot(Jd_qd.T,J) - np.dot(xdd_des.T,J)).T
+        Q, c = self.CalcJacobianTypeCostCoefficients(J, Jd_qd, xdd_des, weight=weight)
 
         return self.mp.AddQuadraticCost(Q,c,qdd, is_convex=True)
 
@@ -95,7 +132,7 @@ class IDController(BasicController):
 
         num_contacts = len(J_c)
         for j in range(num_contacts):
-            pd = (J_c[j]@v).reshape(3,1)
+            pd = J_c[j]@v
             pdd_des = -Kd@pd
 
             constraint = self.AddJacobianTypeConstraint(J_c[j], vd, Jdv_c[j], pdd_des)
@@ -165,14 +202,7 @@ class IDController(BasicController):
         omega_body = (J_body@v)[:3]   # angular velocity of the body
         rpyd_body = RPY_body.CalcRpyDtFromAngularVelocityInParent(omega_body)
 
-        p_lf, J_lf, Jdv_lf = self.CalcFramePositionQuantities(self.lf_foot_frame)
-        p_rf, J_rf, Jdv_rf = self.CalcFramePositionQuantities(self.rf_foot_frame)
-        p_lh, J_lh, Jdv_lh = self.CalcFramePositionQuantities(self.lh_foot_frame)
-        p_rh, J_rh, Jdv_rh = self.CalcFramePositionQuantities(self.rh_foot_frame)
-
-        p_feet = np.array([p_lf, p_rf, p_lh, p_rh]).reshape(4,3)
-        J_feet = np.array([J_lf, J_rf, J_lh, J_rh])
-        Jdv_feet = np.array([Jdv_lf, Jdv_rf, Jdv_lh, Jdv_rh])
+        p_feet, J_feet, Jdv_feet = self.CalcAllFootJacobians()
         pd_feet = J_feet@v
 
         p_s = p_feet[swing_feet]
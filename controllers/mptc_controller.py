@@ -27,6 +27,45 @@ class MPTCController(BasicController):
         self.last_Jbar = None
         self.last_contact_feet = None
 
+        ######### Tuning Parameters #########
+        Kp_body_p = 100.0
+        Kd_body_p = 10.0
+
+        Kp_body_rpy = Kp_body_p
+        Kd_body_rpy = Kd_body_p
+
+        Kp_foot = 200.0
+        Kd_foot = 20.0
+        #####################################
+
+        # Feedback gain matrices only depend on the number of swing feet, so we
+        # construct them once here. These lists are indexed by the number of swing feet.
+        self._Kp_by_nswing, self._Kd_by_nswing = self._BuildFeedbackGains(Kp_body_p, Kd_body_p,
+                                                                          Kp_body_rpy, Kd_body_rpy,
+                                                                          Kp_foot, Kd_foot)
+
+    def _BuildFeedbackGains(self, Kp_body_p, Kd_body_p, Kp_body_rpy, Kd_body_rpy, Kp_foot, Kd_foot):
+        """
+        Construct the task-space feedback gain matrices Kp, Kd for each possible
+        number of swing feet. Returns lists of Kp and Kd matrices, indexed by 
+        the number of swing feet.
+        """
+        Kp_by_nswing = []
+        Kd_by_nswing = []
+        for num_swing in range(5):
+            nf = 3*num_swing   # there are 3 foot-related variables (x,y,z positions) for each swing foot
+
+            Kp = np.block([[ np.kron(np.diag([Kp_body_rpy, Kp_body_p]),np.eye(3)), np.zeros((6,nf))   ],
+                           [ np.zeros((nf,6)),                                     Kp_foot*np.eye(nf) ]])
+
+            Kd = np.block([[ np.kron(np.diag([Kd_body_rpy, Kd_body_p]),np.eye(3)), np.zeros((6,nf))   ],
+                           [ np.zeros((nf,6)),                                     Kd_foot*np.eye(nf) ]])
+
+            Kp_by_nswing.append(Kp)
+            Kd_by_nswing.append(Kd)
+
+        return Kp_by_nswing, Kd_by_nswing
+
     def AddTaskForceCost(self, Jbar, f_des, S, tau, J_c, f_c, W):
         """
         Add a quadratic cost of the form
@@ -140,15 +179,6 @@ class MPTCController(BasicController):
 
         """
         ######### Tuning Parameters #########
-        Kp_body_p = 100.0
-        Kd_body_p = 10.0
-
-        Kp_body_rpy = Kp_body_p
-        Kd_body_rpy = Kd_body_p
-
-        Kp_foot = 200.0
-        Kd_foot = 20.0
-
         w_body = 10.0
         w_foot = 1.0
         #####################################
@@ -259,11 +289,8 @@ class MPTCController(BasicController):
         # Feedback gain and weighting matrices
         nf = 3*sum(swing_feet)   # there are 3 foot-related variables (x,y,z positions) for each swing foot
        
-        Kp = np.block([[ np.kron(np.diag([Kp_body_rpy, Kp_body_p]),np.eye(3)), np.zeros((6,nf))   ],
-                       [ np.zeros((nf,6)),                                     Kp_foot*np.eye(nf) ]])
-        
-        Kd = np.block([[ np.kron(np.diag([Kd_body_rpy, Kd_body_p]),np.eye(3)), np.zeros((6,nf))   ],
-                       [ np.zeros((nf,6)),                                     Kd_foot*np.eye(nf) ]])
+        Kp = self._Kp_by_nswing[num_swing]
+        Kd = self._Kd_by_nswing[num_swing]
 
         W = np.diag(np.hstack([w_body*np.ones(6),w_foot*np.ones(nf)]))  # Note: premultiplying by Lambda^{-1} ensures
                                                                         # passivity despite conflicting tasks
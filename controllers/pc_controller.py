@@ -11,6 +11,22 @@ class PCController(MPTCController):
     def __init__(self, plant, dt, use_lcm=False):
         MPTCController.__init__(self, plant, dt, use_lcm=use_lcm)
 
+        ######### Tuning Parameters #########
+        Kp_body_p = 100.0
+        Kd_body_p = 10.0
+
+        Kp_body_rpy = Kp_body_p
+        Kd_body_rpy = Kd_body_p
+
+        Kp_foot = 200.0
+        Kd_foot = 20.0
+        #####################################
+
+        # Feedback gain matrices, indexed by the number of swing feet
+        self._Kp_by_nswing, self._Kd_by_nswing = self._BuildFeedbackGains(Kp_body_p, Kd_body_p,
+                                                                          Kp_body_rpy, Kd_body_rpy,
+                                                                          Kp_foot, Kd_foot)
+
     def AddVdotConstraint(self, Jbar, S, J_c, tau, f_c, tau_g, Lambda, \
                           Q, v, Kp, xdd_nom, xd_tilde, x_tilde, delta):
         """
@@ -61,15 +77,6 @@ class PCController(MPTCController):
 
         """
         ######### Tuning Parameters #########
-        Kp_body_p = 100.0
-        Kd_body_p = 10.0
-
-        Kp_body_rpy = Kp_body_p
-        Kd_body_rpy = Kd_body_p
-
-        Kp_foot = 200.0
-        Kd_foot = 20.0
-
         w_body = 10.0
         w_foot = 1.0
         w_Vdot = 0.00
@@ -181,11 +188,8 @@ class PCController(MPTCController):
         # Feedback gain and weighting matrices
         nf = 3*sum(swing_feet)   # there are 3 foot-related variables (x,y,z positions) for each swing foot
        
-        Kp = np.block([[ np.kron(np.diag([Kp_body_rpy, Kp_body_p]),np.eye(3)), np.zeros((6,nf))   ],
-                       [ np.zeros((nf,6)),                                     Kp_foot*np.eye(nf) ]])
-        
-        Kd = np.block([[ np.kron(np.diag([Kd_body_rpy, Kd_body_p]),np.eye(3)), np.zeros((6,nf))   ],
-                       [ np.zeros((nf,6)),                                     Kd_foot*np.eye(nf) ]])
+        Kp = self._Kp_by_nswing[num_swing]
+        Kd = self._Kd_by_nswing[num_swing]
 
         W = np.diag(np.hstack([w_body*np.ones(6),w_foot*np.ones(nf)]))  # Note: premultiplying by Lambda^{-1} ensures
                                                                         # passivity despite conflicting tasks
@@ -31,3 +31,23 @@ def jacobian2(function, x):
         yds.append(yd)
 
     return np.vstack(yds).reshape(y_ad.shape + (-1,))
+
+def rpyd_to_angular_velocity_matrix(rpy):
+    """
+    Compute the matrix E(rpy) relating the time derivative of roll-pitch-yaw
+    angles to angular velocity expressed in the parent frame,
+
+        omega = E(rpy)*rpyd.
+
+    This is the same transformation used by Drake's
+    RollPitchYaw.CalcAngularVelocityInParentFromRpyDt, but allows us to 
+    reuse E for several different rpyd vectors.
+    """
+    sp = np.sin(rpy[1])
+    cp = np.cos(rpy[1])
+    sy = np.sin(rpy[2])
+    cy = np.cos(rpy[2])
+
+    return np.array([[ cp*cy, -sy, 0.0],
+                     [ cp*sy,  cy, 0.0],
+                     [   -sp, 0.0, 1.0]])
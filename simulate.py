@@ -5,6 +5,7 @@ from controllers import *
 from planners import BasicTrunkPlanner, TowrTrunkPlanner
 import os
 import sys
+import argparse
 
 ############### Common Parameters ###################
 show_trunk_model = True
@@ -26,6 +27,13 @@ make_plots = False
 
 #####################################################
 
+# Allow the timestep to be set from the command line, e.g. ./simulate.py --dt 2e-3
+parser = argparse.ArgumentParser()
+parser.add_argument("--dt", type=float, default=dt, 
+                    help="timestep (in seconds) for the plant and controller")
+dt = parser.parse_args().dt
+
+
 # Drake only loads things relative to the drake path, so we have to do some hacking
 # to load an arbitrary file
 robot_description_path = "./models/mini_cheetah/mini_cheetah_mesh.urdf"
@@ -158,6 +166,7 @@ if show_diagram:
 
 # Simulator setup
 simulator = Simulator(diagram, diagram_context)
+simulator.set_publish_every_time_step(False)
 if use_lcm:
     # If we're using LCM to send messages to another simulator or a real
     # robot, we don't want Drake to slow things down, so we'll publish
@@ -178,7 +187,9 @@ qd0 = np.zeros(plant.num_velocities())
 plant.SetPositions(plant_context,q0)
 plant.SetVelocities(plant_context,qd0)
 
-# Run the simulation!
+# Run the simulation! We initialize explicitly so that any one-time setup
+# happens before the first step rather than during it.
+simulator.Initialize()
 simulator.AdvanceTo(sim_time)
 
 if make_plots: